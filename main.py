@@ -8,28 +8,22 @@ from src.config.settings import (
     ORIGINAL_VIDEO,
     START_BATCH_TO_UPSCALE,
     STEP_PER_BATCH,
-    TMP_VIDEO_PATH,
 )
 from src.video_processing.audio import extract_audio, insert_audio
 from src.video_processing.frames import extract_frames_to_batches, get_fps_accurate
-from src.video_processing.upscale import delete_upscaled_frames, upscale_batches
+from src.video_processing.upscale import upscale_batches
 from src.video_processing.video_assembly import VideoHandler
 
 
 def main():
     """Основной процесс обработки видео."""
-    tmp_final_video = os.path.join(TMP_VIDEO_PATH, "tmp_final_video.mp4")
-
     fps = get_fps_accurate(ORIGINAL_VIDEO)
     audio = extract_audio()
     extract_frames_to_batches()
 
     start_batch = START_BATCH_TO_UPSCALE
     end_batch = 0
-    tmp_videos_counter = 1
-    tmp_builder = VideoHandler(
-        fps=fps, tmp_video_name=f"tmp_video_{tmp_videos_counter}"
-    )
+    tmp_builder = VideoHandler(fps=fps, tmp_video_name="tmp_final_video")
 
     if END_BATCH_TO_UPSCALE == 0:
         # -1 потому что файл .gitkeep в INPUT_BATCHES_DIR тоже считается
@@ -45,24 +39,24 @@ def main():
             # иначе берем все оставшиеся батчи до конца
             end_batch = end_batch_to_upscale
 
+        # Ждем, пока на диске будет место для улучшенных фреймов шага
+        tmp_builder.reserve_batches((start_batch, end_batch))
+
         # Запуск обработки батчей
         asyncio.run(upscale_batches(start_batch, end_batch))
 
-        batches_to_perform = [f"batch_{i}" for i in range(start_batch, end_batch + 1)]
-        short_video = tmp_builder.process_frames_to_video(batches_to_perform)
-        if short_video:
-            delete_upscaled_frames()
-            print(f"Партия фреймов {short_video} успешно обработана и объединена.")
-        if tmp_builder.current_short_video_count == tmp_builder.MAX_SHORT_VIDEOS:
-            tmp_videos_counter += 1
-            tmp_builder = VideoHandler(
-                fps=fps, tmp_video_name=f"tmp_video_{tmp_videos_counter}"
-            )
+        # Кодирование идет в фоне, параллельно с апскейлом следующих батчей.
+        # Фреймы батча удаляются сразу после сборки его видео
+        tmp_builder.process_frames_to_video((start_batch, end_batch))
+        print(f"Батчи {start_batch}-{end_batch} поставлены в очередь на сборку видео.")
 
         start_batch += STEP_PER_BATCH
 
+    # Все короткие видео склеиваются одним вызовом ffmpeg без перекодирования
+    tmp_final_video = tmp_builder.build_final_video()
+
     if audio:
-        insert_audio(audio, fps, video_path=tmp_final_video, output_path=FINAL_VIDEO)
+        insert_audio(audio, video_path=tmp_final_video, output_path=FINAL_VIDEO)
     else:
         print("Звуковой файл не найден, финальное видео сохранено без звука.")
 
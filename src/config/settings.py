@@ -19,10 +19,18 @@ OUTPUT_BATCHES_DIR = os.getenv(
 )
 
 # Файловые параметры апскейлера
-RESOLUTION = os.getenv("RESOLUTION", "4K")
 START_BATCH_TO_UPSCALE = int(os.getenv("START_BATCH_TO_UPSCALE", 1))
 END_BATCH_TO_UPSCALE = int(os.getenv("END_BATCH_TO_UPSCALE", 0))
 STEP_PER_BATCH = int(os.getenv("STEP_PER_BATCH", 6))
+# Сколько улучшенных батчей (вместе с батчами, которые сейчас улучшаются) может
+# ждать сборки видео: ограничивает место на диске, занятое улучшенными фреймами.
+# Апскейл очередного шага начинается, только когда для всех его батчей есть место
+MAX_PENDING_BATCHES = int(os.getenv("MAX_PENDING_BATCHES", 12))
+if MAX_PENDING_BATCHES < max(1, STEP_PER_BATCH):
+    raise ValueError(
+        "MAX_PENDING_BATCHES должен быть не меньше 1 и не меньше STEP_PER_BATCH, "
+        f"сейчас {MAX_PENDING_BATCHES}"
+    )
 FRAMES_PER_BATCH = int(os.getenv("FRAMES_PER_BATCH", 1000))
 ALLOWED_THREADS = int(os.getenv("ALLOWED_THREADS", 6))
 
@@ -34,4 +42,35 @@ REALESRGAN_SCRIPT = os.getenv(
     f"{ROOT_DIR}/src/utils/realesrgan/realesrgan-linux/realesrgan-ncnn-vulkan",
 )
 UPSCALE_FACTOR = int(os.getenv("UPSCALE_FACTOR", 2))
+UPSCALER_STARTUP_DELAY = float(os.getenv("UPSCALER_STARTUP_DELAY", 0.25))
+# Размер тайла (0 - подбирается автоматически по объему видеопамяти)
+UPSCALER_TILE_SIZE = int(os.getenv("UPSCALER_TILE_SIZE", 0))
+# Номера GPU через запятую, процессы апскейлера распределяются по ним по кругу.
+# Пустое значение - GPU выбирает сам апскейлер
+UPSCALER_GPU_IDS = os.getenv("UPSCALER_GPU_IDS", "")
+# Потоки загрузки:обработки:сохранения фреймов внутри одного процесса апскейлера
+UPSCALER_JOBS = os.getenv("UPSCALER_JOBS", "1:2:2")
+# Формат улучшенных фреймов: jpg, png (без потерь, но объемнее) или webp
 OUTPUT_IMAGE_FORMAT = os.getenv("OUTPUT_IMAGE_FORMAT", "jpg")
+
+# Настройка сборки видео
+# Кодер коротких видео; auto - первый доступный из h264_nvenc, h264_qsv, иначе libx264
+VIDEO_CODEC = os.getenv("VIDEO_CODEC", "auto")
+# Пресет кодера, применяется только при явно заданном VIDEO_CODEC; пустое
+# значение - veryfast для libx264, p4 для h264_nvenc и medium для h264_qsv
+VIDEO_PRESET = os.getenv("VIDEO_PRESET", "")
+# Сколько коротких видео одновременно кодирует аппаратный кодер: число сессий
+# NVENC на потребительских видеокартах ограничено драйвером
+HARDWARE_ENCODER_SESSIONS = int(os.getenv("HARDWARE_ENCODER_SESSIONS", 2))
+if HARDWARE_ENCODER_SESSIONS < 1:
+    raise ValueError(
+        "HARDWARE_ENCODER_SESSIONS должен быть не меньше 1, "
+        f"сейчас {HARDWARE_ENCODER_SESSIONS}"
+    )
+# Качество: crf для программных кодеров, cq для h264_nvenc
+VIDEO_QUALITY = int(os.getenv("VIDEO_QUALITY", 18))
+# Потоки одного процесса ffmpeg. Короткие видео кодируются в ALLOWED_THREADS
+# процессов одновременно, поэтому при 0 ядра делятся между ними поровну
+VIDEO_ENCODER_THREADS = int(os.getenv("VIDEO_ENCODER_THREADS", 0)) or max(
+    1, (os.cpu_count() or 1) // ALLOWED_THREADS
+)
@@ -1,9 +1,10 @@
 import os
 from typing import Optional
 
-from moviepy.editor import AudioFileClip, CompositeAudioClip, VideoFileClip
+import ffmpeg
+from moviepy.editor import VideoFileClip
 
-from src.config.settings import ALLOWED_THREADS, AUDIO_PATH, ORIGINAL_VIDEO, RESOLUTION
+from src.config.settings import AUDIO_PATH, ORIGINAL_VIDEO
 
 
 def get_audio_full_path(video_path: str, audio_dir: str, extension: str = "aac") -> str:
@@ -56,43 +57,36 @@ def extract_audio(
 
 def insert_audio(
     audio_path: str,
-    fps: float,
     video_path: str,
     output_path: str,
     audio_format: str = "mp3",
-    resolution: str = RESOLUTION,
 ) -> None:
     """
-    Добавляет аудиофайл в видео, сохраняя оригинальное качество видео и аудио, с учетом разрешения видео.
+    Добавляет аудиофайл в видео без перекодирования видеопотока: видео уже имеет
+    нужные разрешение и частоту кадров, поэтому достаточно смешать потоки в
+    новом контейнере.
 
     :param audio_path: Путь к аудиофайлу.
-    :param fps: Количество кадров в секунду.
-    :param audio_format: Расширение аудиофайла. По умолчанию 'mp3'.
     :param video_path: Путь к видеофайлу, в который будет добавлено аудио.
     :param output_path: Путь к итоговому файлу, куда будет сохранено видео с аудиодорожкой.
-    :param resolution: Разрешение видео ('4K' или '8K'), чтобы задать соответствующий битрейт. По умолчанию '4K'.
+    :param audio_format: Расширение аудиофайла. По умолчанию 'mp3'.
     :return: None
     """
-    with VideoFileClip(video_path) as video, AudioFileClip(audio_path) as audio:
-        audio_set = CompositeAudioClip([audio])
-        video_with_audio = video.set_audio(audio_set)
-        print(
-            f"Планируется добавление аудиодорожки в видео со следующими параметрами:"
-            f"\n\tкодек - `libx265`"
-            f"\n\tформат аудио - `{audio_format}`"
-            f"\n\tчастота кадров - `{fps}`"
-            f"\n\tпресет - `slow`"
-            f"\n\tколичество потоков - `{ALLOWED_THREADS}`"
-            f"\n\tбитрейт - `{'20000k' if resolution == '4K' else '40000k'}`"
-            f"\n\tразрешение - `{resolution}`"
-        )
-        video_with_audio.write_videofile(
-            output_path,
-            codec="libx265",
-            audio_codec=audio_format,
-            fps=fps,
-            preset="slow",
-            threads=ALLOWED_THREADS,
-            bitrate="20000k" if resolution == "4K" else "40000k",
-        )
-        print(f"Аудиодорожка добавлена в видеофайл {output_path}.")
+    # mp3 и aac контейнер mp4 принимает как есть, остальное перекодируем в aac
+    audio_codec = "copy" if audio_format in ("mp3", "aac") else "aac"
+    print(
+        f"Планируется добавление аудиодорожки в видео со следующими параметрами:"
+        f"\n\tвидео - `без перекодирования`"
+        f"\n\tаудио - `{audio_format}`, кодек - `{audio_codec}`"
+    )
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    ffmpeg.output(
+        ffmpeg.input(video_path).video,
+        ffmpeg.input(audio_path).audio,
+        output_path,
+        vcodec="copy",
+        acodec=audio_codec,
+        shortest=None,
+        movflags="+faststart",
+    ).overwrite_output().run()
+    print(f"Аудиодорожка добавлена в видеофайл {output_path}.")
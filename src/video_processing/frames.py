@@ -1,21 +1,23 @@
-import glob
 import os
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from typing import Iterable
 
-import cv2
 import ffmpeg
 from colorama import Fore, Style
 from tqdm import tqdm
 
 from src.config.settings import (
-    ALLOWED_THREADS,
     FRAMES_PER_BATCH,
     INPUT_BATCHES_DIR,
     ORIGINAL_VIDEO,
     OUTPUT_IMAGE_FORMAT,
 )
 from src.utils.batch_utils import make_default_batch_dir
+from src.utils.file_utils import create_dir
+
+# Формат извлеченных из исходного видео кадров, которые подаются на апскейл
+INPUT_IMAGE_FORMAT = "jpg"
 
 
 def get_fps_accurate(video_path: str) -> float:
@@ -24,49 +26,31 @@ def get_fps_accurate(video_path: str) -> float:
     :param video_path: Путь к видеофайлу.
     :return: Среднее количество кадров в секунду.
     """
-    # Проверяем, что видео доступно и открывается
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
+    # Получаем метаданные видеопотока с помощью ffmpeg, заодно проверяя, что видео
+    # доступно. Кадры не декодируются и не пересчитываются
+    try:
+        metadata = ffmpeg.probe(video_path, select_streams="v:0")
+        video_stream = metadata["streams"][0]
+    except (ffmpeg.Error, IndexError):
         raise Exception(f"Не удалось открыть видео {video_path}")
 
     print(f"Файл {video_path} существует и доступен для обработки.")
-    # Получаем метаданные видео с помощью ffmpeg
-    metadata = ffmpeg.probe(video_path)
-    duration = float(metadata["format"]["duration"])
-    if duration == 0:
-        raise ZeroDivisionError("Видео имеет нулевую длительность")
-
-    # Пытаемся получить количество кадров из метаданных
-    nb_frames = metadata["streams"][0].get("nb_frames")
-    if nb_frames is not None:
-        print(f"В метаданных видеофайла есть информация о количестве кадров...")
-        frames = int(nb_frames)
+    # avg_frame_rate - средняя частота по всему потоку, r_frame_rate - базовая
+    # частота потока на случай, если контейнер не хранит среднюю (0/0)
+    for rate_key in ("avg_frame_rate", "r_frame_rate"):
+        try:
+            fps = float(Fraction(video_stream.get(rate_key, "0/0")))
+        except ZeroDivisionError:
+            continue
+        if fps > 0:
+            break
     else:
-        # Если информация о количестве кадров отсутствует, считаем их с помощью OpenCV
-        print(f"Считаем количество кадров с помощью OpenCV...")
-        frames = 0
-        while True:
-            ret, _ = cap.read()
-            if not ret:
-                break
-            frames += 1
-
-    cap.release()
-    fps = frames / duration
+        raise Exception(f"Не удалось определить частоту кадров видео {video_path}")
+
     print(f"\tСреднее количество кадров в секунду: {fps}")
     return fps
 
 
-def compare_strings(string: str) -> int:
-    """
-    Сравнивает строку с числом в конце имени файла.
-    :param string: Строка, содержащая имя файла.
-    :return: Число в конце имени файла.
-    """
-    num = int(string.split("_")[-1]) if "_" in string else int(string)
-    return num
-
-
 def form_frame_name(path_to_frame: str, num: int) -> str:
     """
     Формирует имя файла для указанного номера кадра в таком формате:
@@ -77,7 +61,28 @@ def form_frame_name(path_to_frame: str, num: int) -> str:
     :param num: Номер кадра.
     :return: Имя файла.
     """
-    return os.path.join(path_to_frame, f"frame_{num:08d}.jpg")
+    return os.path.join(path_to_frame, f"frame_{num:08d}.{INPUT_IMAGE_FORMAT}")
+
+
+def _distribute_frames_to_batches(
+    source_dir: str, output_dir: str, batch_size: int
+) -> None:
+    """
+    Раскладывает пронумерованные кадры из одной директории по директориям батчей.
+    Файлы переносятся переименованием, без копирования данных.
+    :param source_dir: Директория с кадрами frame_00000001.jpg, frame_00000002.jpg...
+    :param output_dir: Базовая директория для сохранения батчей с кадрами.
+    :param batch_size: Количество кадров в одном батче.
+    """
+    frames_count = len(os.listdir(source_dir))
+    for first_frame in range(1, frames_count + 1, batch_size):
+        batch_dir = make_default_batch_dir(output_dir)
+        last_frame = min(first_frame + batch_size - 1, frames_count)
+        for frame_num in range(first_frame, last_frame + 1):
+            os.replace(
+                form_frame_name(source_dir, frame_num),
+                form_frame_name(batch_dir, frame_num),
+            )
 
 
 def extract_frames_to_batches(
@@ -86,64 +91,94 @@ def extract_frames_to_batches(
     batch_size: int = FRAMES_PER_BATCH,
 ) -> None:
     """
-    Извлекает кадры из видеофайла и сохраняет их по батчам в папках по 1000 кадров.
+    Извлекает кадры из видеофайла одним вызовом ffmpeg и сохраняет их по батчам
+    в папках по 1000 кадров.
     :param video_path: Путь к исходному видеофайлу.
     :param output_dir: Базовая директория для сохранения батчей с кадрами.
     :param batch_size: Количество кадров в одном батче.
     """
-    video_capture = cv2.VideoCapture(video_path)
-    frame_count = 0
-    increments = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    try:
+        video_stream = ffmpeg.probe(video_path, select_streams="v:0")["streams"][0]
+        total_frames = int(video_stream["nb_frames"])
+    except (ffmpeg.Error, IndexError, KeyError, ValueError):
+        # Без количества кадров tqdm покажет прогресс без общего объема
+        total_frames = None
+
+    # Декодирование и кодирование JPEG выполняет сам ffmpeg на всех ядрах, а
+    # декодирование видео - на GPU, если оно доступно
+    staging_dir = create_dir(output_dir, ".extracting")
+    process = (
+        ffmpeg.input(video_path, hwaccel="auto")
+        .output(
+            # Шаблон имени совпадает с form_frame_name
+            os.path.join(staging_dir, f"frame_%08d.{INPUT_IMAGE_FORMAT}"),
+            vsync=0,
+            threads=0,
+            **{"qscale:v": 2},
+        )
+        .global_args("-loglevel", "error", "-nostats", "-progress", "pipe:1")
+        .overwrite_output()
+        .run_async(pipe_stdout=True)
+    )
 
     print("Извлечение кадров из оригинального видеофайла...")
     with tqdm(
-        total=increments,
+        total=total_frames,
         desc=f"{Fore.GREEN}Фреймов извлечено{Style.RESET_ALL}",
         ncols=150,
         colour="green",
         file=sys.stdout,
     ) as pbar:
-        with ThreadPoolExecutor(max_workers=ALLOWED_THREADS) as executor:
-            current_batch_dir = make_default_batch_dir(output_dir)
-
-            while True:
-                ret, frame = video_capture.read()
-                if not ret:
-                    break
-
-                # Формируем путь для кадра и добавляем задачу на запись кадра
-                frame_path = form_frame_name(current_batch_dir, frame_count + 1)
-                executor.submit(
-                    cv2.imwrite, frame_path, frame, [int(cv2.IMWRITE_JPEG_QUALITY), 100]
-                )
-
-                frame_count += 1
-                pbar.update(1)  # Обновляем прогресс-бар
-
-                # Если текущий батч заполнен, создаем новый
-                if frame_count % batch_size == 0:
-                    current_batch_dir = make_default_batch_dir(output_dir)
-
-    video_capture.release()
+        # ffmpeg пишет прогресс блоками строк key=value, номер последнего
+        # записанного кадра - в строке frame=
+        for line in process.stdout:
+            key, _, value = line.decode().strip().partition("=")
+            if key == "frame":
+                pbar.update(int(value) - pbar.n)
+
+    if process.wait() != 0:
+        raise Exception(f"Не удалось извлечь кадры из видео {video_path}")
+
+    _distribute_frames_to_batches(staging_dir, output_dir, batch_size)
+    os.rmdir(staging_dir)
     print("Извлечение завершено.")
 
 
 def count_total_frames(directory: str) -> int:
     """Считает общее количество фреймов во всех батчах."""
-    return sum(
-        len(glob.glob(os.path.join(batch, f"*.{OUTPUT_IMAGE_FORMAT}")))
-        for batch in glob.glob(os.path.join(directory, "batch_*"))
-    )
+    with os.scandir(directory) as entries:
+        return sum(
+            count_frames_in_dir(entry.path)
+            for entry in entries
+            if entry.name.startswith("batch_") and entry.is_dir()
+        )
 
 
-def count_frames_in_certain_batches(directory: str, batches_num_range: range) -> int:
+def count_frames_in_dir(
+    directory: str, image_format: str = OUTPUT_IMAGE_FORMAT
+) -> int:
+    """
+    Считает количество фреймов в одной директории.
+    :param directory: Путь к директории с фреймами.
+    :param image_format: Расширение файлов фреймов.
+    :return: Количество фреймов или 0, если директория еще не создана.
+    """
+    extension = f".{image_format}"
+    try:
+        # scandir не делает stat на каждый файл и не строит список путей
+        with os.scandir(directory) as entries:
+            return sum(1 for entry in entries if entry.name.endswith(extension))
+    except FileNotFoundError:
+        return 0
+
+
+def count_frames_in_certain_batches(
+    directory: str,
+    batches_num_range: Iterable[int],
+    image_format: str = OUTPUT_IMAGE_FORMAT,
+) -> int:
     """Считает общее количество фреймов в указанных батчах."""
-    frames_in_batches = 0
-
-    for batch_num in batches_num_range:
-        batch_dir = os.path.join(directory, f"batch_{batch_num}")
-        frames_in_batches += len(
-            glob.glob(os.path.join(batch_dir, f"*.{OUTPUT_IMAGE_FORMAT}"))
-        )
-
-    return frames_in_batches
+    return sum(
+        count_frames_in_dir(os.path.join(directory, f"batch_{batch_num}"), image_format)
+        for batch_num in batches_num_range
+    )
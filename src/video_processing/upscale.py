@@ -1,10 +1,9 @@
 import asyncio
-import glob
 import os
-import subprocess
+import shutil
 import sys
-from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Optional
 
 from colorama import Fore, Style
 from tqdm import tqdm
@@ -18,37 +17,55 @@ from src.config.settings import (
     OUTPUT_IMAGE_FORMAT,
     REALESRGAN_SCRIPT,
     UPSCALE_FACTOR,
+    UPSCALER_GPU_IDS,
+    UPSCALER_JOBS,
+    UPSCALER_STARTUP_DELAY,
+    UPSCALER_TILE_SIZE,
+)
+from src.utils.file_utils import create_dir
+from src.video_processing.frames import (
+    INPUT_IMAGE_FORMAT,
+    count_frames_in_certain_batches,
 )
-from src.utils.file_utils import create_dir, delete_dir, delete_object
-from src.video_processing.frames import count_frames_in_certain_batches
-
 
-def delete_upscaled_frames(del_only_dirs=True):
-    """
-    Удаляет кадры из указанной директории.
-    Если `del_only_dirs` установлено в True, удаляются только директории, иначе — и файлы, и директории.
-    :param del_only_dirs: Флаг для удаления только директорий. Если False, удаляет и файлы, и директории.
-    """
-    file_paths = glob.glob(os.path.join(OUTPUT_BATCHES_DIR, "*"))
+# Интервал обновления прогресс-бара апскейла, в секундах
+PROGRESS_UPDATE_INTERVAL = 1.0
 
-    for file_path in file_paths:
-        try:
-            # Проверка типа объекта перед удалением
-            if del_only_dirs and os.path.isdir(file_path):
-                delete_dir(file_path)
-            elif not del_only_dirs:
-                delete_object(file_path)
-            else:
-                print(f"Пропущен файл: {file_path} (del_only_dirs=True)")
-        except Exception as e:
-            print(f"Не удалось удалить {file_path}. Причина: {e}")
+# Неизменные между запусками параметры апскейлера собираются один раз
+_REALESRGAN_OPTIONS = (
+    "-n",
+    MODEL_NAME,
+    "-s",
+    str(UPSCALE_FACTOR),
+    "-f",
+    OUTPUT_IMAGE_FORMAT,
+    "-m",
+    MODEL_DIR,
+    "-t",
+    str(UPSCALER_TILE_SIZE),
+    "-j",
+    UPSCALER_JOBS,
+    "-v",
+)
+# GPU, по которым по кругу распределяются процессы апскейлера
+_GPU_IDS = [gpu_id.strip() for gpu_id in UPSCALER_GPU_IDS.split(",") if gpu_id.strip()]
 
 
 async def monitor_progress(
-    total_frames: int, is_processing: list, batch_numbers: range
+    total_frames: int,
+    processing_done: asyncio.Event,
+    batch_numbers: List[int],
+    processed_frames: List[int],
 ):
-    """Мониторинг прогресса с одним глобальным прогресс-баром."""
-    processed_frames = 0
+    """
+    Мониторинг прогресса с одним глобальным прогресс-баром.
+    Счетчик ведут сами задачи апскейла по выводу апскейлера, поэтому
+    директории с фреймами не сканируются.
+    :param total_frames: Общее количество фреймов в обрабатываемых батчах.
+    :param processing_done: Событие завершения обработки всех батчей.
+    :param batch_numbers: Номера обрабатываемых батчей.
+    :param processed_frames: Счетчик улучшенных фреймов в виде списка из одного элемента.
+    """
     with tqdm(
         total=total_frames,
         desc=f"{Fore.GREEN}Обработка батчей "
@@ -58,72 +75,234 @@ async def monitor_progress(
         colour="green",
         file=sys.stdout,
     ) as pbar:
-        while is_processing[0]:
-            if processed_frames >= total_frames:
-                break
-            processed_frames = count_frames_in_certain_batches(
-                OUTPUT_BATCHES_DIR, batch_numbers
-            )
-            pbar.n = processed_frames
-            pbar.refresh()
-            await asyncio.sleep(1)  # Пауза для периодического обновления
+        while not processing_done.is_set():
+            if processed_frames[0] != pbar.n:
+                # Перерисовка строки прогресс-бара только при изменении счетчика,
+                # update() к тому же сам троттлит вывод по mininterval
+                pbar.update(processed_frames[0] - pbar.n)
+            try:
+                # Пауза до следующего обновления, прерываемая завершением обработки
+                await asyncio.wait_for(
+                    processing_done.wait(), timeout=PROGRESS_UPDATE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+        pbar.update(processed_frames[0] - pbar.n)
         pbar.close()
 
 
-def _upscale(batch_num: int):
-    """Функция улучшения фреймов в батче."""
-    input_dir = Path(INPUT_BATCHES_DIR) / f"batch_{batch_num}"
-    output_dir = create_dir(OUTPUT_BATCHES_DIR, f"batch_{batch_num}")
+def _is_batch_upscaled(batch_num: int) -> bool:
+    """
+    Проверяет, что батч уже полностью улучшен (например, при прошлом запуске).
+    :param batch_num: Номер батча.
+    :return: True, если в выходной директории батча столько же фреймов, сколько во входной.
+    """
+    batch_range = range(batch_num, batch_num + 1)
+    expected_frames = count_frames_in_certain_batches(
+        INPUT_BATCHES_DIR, batch_range, INPUT_IMAGE_FORMAT
+    )
+    upscaled_frames = count_frames_in_certain_batches(OUTPUT_BATCHES_DIR, batch_range)
+    return upscaled_frames >= expected_frames
+
+
+def _split_into_shards(batch_nums: List[int], shards_count: int) -> List[List[int]]:
+    """
+    Делит батчи на непрерывные группы примерно одинакового размера.
+    :param batch_nums: Номера батчей по возрастанию.
+    :param shards_count: Количество групп.
+    :return: Список групп номеров батчей.
+    """
+    shard_size, remainder = divmod(len(batch_nums), shards_count)
+    shards = []
+    start = 0
+    for shard_index in range(shards_count):
+        end = start + shard_size + (1 if shard_index < remainder else 0)
+        shards.append(batch_nums[start:end])
+        start = end
+    return shards
+
+
+def _get_shard_dir(batch_nums: List[int]) -> str:
+    """Возвращает путь к временной директории группы батчей."""
+    return os.path.join(OUTPUT_BATCHES_DIR, f".shard_{batch_nums[0]}-{batch_nums[-1]}")
+
+
+def _stage_shard(batch_nums: List[int]) -> Dict[str, int]:
+    """
+    Собирает фреймы группы батчей в одну входную директорию, чтобы апскейлер
+    загрузил модель один раз на всю группу. Фреймы не копируются, а связываются
+    жесткими ссылками: realesrgan-ncnn-vulkan пропускает симлинки.
+    :param batch_nums: Номера батчей группы.
+    :return: Соответствие имени фрейма (без расширения) номеру его батча.
+    """
+    shard_dir = _get_shard_dir(batch_nums)
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)  # остатки прерванного запуска
+    input_dir = create_dir(shard_dir, "input")
+    create_dir(shard_dir, "output")
+
+    frame_batches = {}
+    for batch_num in batch_nums:
+        with os.scandir(Path(INPUT_BATCHES_DIR) / f"batch_{batch_num}") as entries:
+            for entry in entries:
+                staged_path = os.path.join(input_dir, entry.name)
+                try:
+                    os.link(entry.path, staged_path)
+                except OSError:
+                    # жесткая ссылка невозможна, например, между разными ФС
+                    shutil.copy2(entry.path, staged_path)
+                frame_batches[os.path.splitext(entry.name)[0]] = batch_num
+    return frame_batches
+
 
-    command = [
+def _unstage_shard(
+    batch_nums: List[int], frame_batches: Dict[str, int], output_dirs: Dict[int, str]
+) -> None:
+    """
+    Раскладывает улучшенные фреймы группы по директориям их батчей и удаляет
+    временную директорию группы.
+    :param batch_nums: Номера батчей группы.
+    :param frame_batches: Соответствие имени фрейма номеру его батча.
+    :param output_dirs: Выходные директории батчей.
+    """
+    shard_dir = _get_shard_dir(batch_nums)
+    with os.scandir(os.path.join(shard_dir, "output")) as entries:
+        for entry in entries:
+            batch_num = frame_batches[os.path.splitext(entry.name)[0]]
+            os.replace(entry.path, os.path.join(output_dirs[batch_num], entry.name))
+    shutil.rmtree(shard_dir)
+
+
+async def _upscale(
+    input_dir: str,
+    output_dir: str,
+    processed_frames: List[int],
+    gpu_id: Optional[str] = None,
+):
+    """
+    Функция улучшения всех фреймов в директории одним запуском апскейлера.
+    :param input_dir: Директория с исходными фреймами.
+    :param output_dir: Заранее созданная директория для улучшенных фреймов.
+    :param processed_frames: Общий счетчик улучшенных фреймов.
+    :param gpu_id: Номер GPU для апскейлера, None - выбор остается за апскейлером.
+    """
+    process = await asyncio.create_subprocess_exec(
         REALESRGAN_SCRIPT,
         "-i",
-        str(input_dir),
+        input_dir,
         "-o",
         output_dir,
-        "-n",
-        MODEL_NAME,
-        "-s",
-        str(UPSCALE_FACTOR),
-        "-f",
-        OUTPUT_IMAGE_FORMAT,
-        "-m",
-        MODEL_DIR,
-    ]
+        *_REALESRGAN_OPTIONS,
+        *(("-g", gpu_id) if gpu_id is not None else ()),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    # С флагом -v апскейлер пишет в stderr строку "<вход> -> <выход> done"
+    # на каждый сохраненный фрейм, по ним и ведется счетчик прогресса
+    error_lines = []
+    async for line in process.stderr:
+        line = line.decode(errors="replace").rstrip()
+        if line.endswith(" done"):
+            processed_frames[0] += 1
+        elif not line.endswith("%"):
+            error_lines.append(line)
+    await process.wait()
 
-    result = subprocess.run(command, capture_output=True, text=True)
+    # Неполный батч нельзя отдавать на сборку видео: в нем не хватает кадров
+    if process.returncode != 0:
+        error_output = "\n".join(error_lines)
+        raise Exception(f"Ошибка при обработке {input_dir}: {error_output}")
 
-    if result.returncode != 0:
-        print(f"Ошибка в батче {batch_num}: {result.stderr}")
+
+async def _upscale_shard(
+    batch_nums: List[int],
+    output_dirs: Dict[int, str],
+    processed_frames: List[int],
+    gpu_id: Optional[str] = None,
+):
+    """
+    Улучшает группу батчей одним запуском апскейлера.
+    :param batch_nums: Номера батчей группы.
+    :param output_dirs: Выходные директории батчей.
+    :param processed_frames: Общий счетчик улучшенных фреймов.
+    :param gpu_id: Номер GPU для апскейлера, None - выбор остается за апскейлером.
+    """
+    if len(batch_nums) == 1:
+        batch_num = batch_nums[0]
+        input_dir = str(Path(INPUT_BATCHES_DIR) / f"batch_{batch_num}")
+        await _upscale(input_dir, output_dirs[batch_num], processed_frames, gpu_id)
+        return
+
+    # Связывание и перенос тысяч файлов блокируют, поэтому выполняются
+    # в отдельном потоке, не останавливая цикл событий и остальные группы
+    frame_batches = await asyncio.to_thread(_stage_shard, batch_nums)
+    shard_dir = _get_shard_dir(batch_nums)
+    try:
+        await _upscale(
+            os.path.join(shard_dir, "input"),
+            os.path.join(shard_dir, "output"),
+            processed_frames,
+            gpu_id,
+        )
+    finally:
+        await asyncio.to_thread(_unstage_shard, batch_nums, frame_batches, output_dirs)
 
 
 async def upscale_batches(start_batch: int, end_batch: int):
+    # Пропускаем батчи, которые уже были улучшены до перезапуска
+    pending_batches = []
+    for batch_num in range(start_batch, end_batch + 1):
+        if _is_batch_upscaled(batch_num):
+            print(f"Батч {batch_num} уже обработан, пропускаем.")
+        else:
+            pending_batches.append(batch_num)
+
+    if not pending_batches:
+        print(f"Батчи {start_batch}-{end_batch} уже обработаны.\n")
+        return
+
     # Считаем общее количество фреймов для отслеживания прогресса
-    batches_range = range(start_batch, end_batch + 1)
     frames_in_curr_batches = count_frames_in_certain_batches(
-        INPUT_BATCHES_DIR, batches_range
+        INPUT_BATCHES_DIR, pending_batches, INPUT_IMAGE_FORMAT
+    )
+    processing_done = asyncio.Event()
+    processed_frames = [0]
+
+    # Создаем директории батчей заранее и последовательно, а не в каждом воркере
+    output_dirs = {
+        batch_num: create_dir(OUTPUT_BATCHES_DIR, f"batch_{batch_num}")
+        for batch_num in pending_batches
+    }
+
+    # Каждый процесс апскейлера получает сразу непрерывную группу батчей,
+    # чтобы модель загружалась один раз на группу, а не на каждый батч
+    shards = _split_into_shards(
+        pending_batches, min(ALLOWED_THREADS, len(pending_batches))
     )
-    is_processing = [True]
+
+    async def run(shard_index: int, shard: List[int]):
+        # Разносим старт процессов во времени, чтобы они не
+        # загружали модель с диска и в GPU одновременно
+        await asyncio.sleep(shard_index * UPSCALER_STARTUP_DELAY)
+        gpu_id = _GPU_IDS[shard_index % len(_GPU_IDS)] if _GPU_IDS else None
+        await _upscale_shard(shard, output_dirs, processed_frames, gpu_id)
 
     # Запускаем задачу мониторинга прогресса
     monitor_task = asyncio.create_task(
-        monitor_progress(frames_in_curr_batches, is_processing, batches_range)
+        monitor_progress(
+            frames_in_curr_batches, processing_done, pending_batches, processed_frames
+        )
     )
 
     try:
-        # Запускаем обработку батчей с использованием ProcessPoolExecutor
-        loop = asyncio.get_event_loop()
-
-        with ProcessPoolExecutor(max_workers=ALLOWED_THREADS) as executor:
-            tasks = [
-                loop.run_in_executor(executor, _upscale, batch_num)
-                for batch_num in batches_range
-            ]
-
-            # Ожидаем завершения всех задач апскейлинга
-            await asyncio.gather(*tasks)
+        # Ожидаем завершения всех задач апскейлинга
+        await asyncio.gather(
+            *(run(shard_index, shard) for shard_index, shard in enumerate(shards))
+        )
 
     finally:
-        is_processing[0] = False  # Завершаем мониторинг прогресса
+        processing_done.set()  # Завершаем мониторинг прогресса
         await monitor_task  # Ожидаем завершения задачи мониторинга
-        print(f"Батчи {start_batch}-{end_batch} обработаны.\n")
+
+    print(f"Батчи {start_batch}-{end_batch} обработаны.\n")
@@ -1,149 +1,393 @@
-import glob
 import os
-from queue import PriorityQueue, Queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
 
 import ffmpeg
-from moviepy.editor import VideoFileClip, concatenate_videoclips
 
-from src.config.settings import BATCH_VIDEO_PATH, OUTPUT_BATCHES_DIR, TMP_VIDEO_PATH
-from src.utils.file_utils import delete_file
+from src.config.settings import (
+    ALLOWED_THREADS,
+    BATCH_VIDEO_PATH,
+    HARDWARE_ENCODER_SESSIONS,
+    INPUT_BATCHES_DIR,
+    MAX_PENDING_BATCHES,
+    OUTPUT_BATCHES_DIR,
+    OUTPUT_IMAGE_FORMAT,
+    TMP_VIDEO_PATH,
+    VIDEO_CODEC,
+    VIDEO_ENCODER_THREADS,
+    VIDEO_PRESET,
+    VIDEO_QUALITY,
+)
+from src.utils.file_utils import delete_dir, delete_file
+from src.video_processing.frames import INPUT_IMAGE_FORMAT, count_frames_in_dir
+
+# Аппаратные кодеры в порядке предпочтения для VIDEO_CODEC=auto
+HARDWARE_VIDEO_CODECS = ("h264_nvenc", "h264_qsv")
+
+# Декодеры ffmpeg для форматов, в которых апскейлер сохраняет фреймы
+IMAGE_DECODERS = {"jpg": "mjpeg", "png": "png", "webp": "webp"}
+
+
+def _get_encoder_options(vcodec: str, preset: str = "") -> dict:
+    """
+    Возвращает параметры ffmpeg для кодирования коротких видео выбранным кодеком.
+    :param vcodec: Имя кодера для ffmpeg.
+    :param preset: Пресет кодера; пустое значение - пресет по умолчанию для кодера.
+    :return: Параметры вывода ffmpeg.
+    """
+    if vcodec == "h264_nvenc":
+        # Аппаратный кодер NVIDIA, качество задается постоянным cq вместо crf
+        return {
+            "vcodec": vcodec,
+            "pix_fmt": "yuv420p",
+            "preset": preset or "p4",
+            "tune": "hq",
+            "rc": "vbr",
+            "cq": VIDEO_QUALITY,
+            "b:v": 0,
+        }
+    if vcodec == "h264_qsv":
+        # Intel Quick Sync принимает кадры только в nv12
+        return {
+            "vcodec": vcodec,
+            "pix_fmt": "nv12",
+            "preset": preset or "medium",
+            "global_quality": VIDEO_QUALITY,
+        }
+    return {
+        "vcodec": vcodec,
+        "pix_fmt": "yuv420p",
+        "preset": preset or "veryfast",
+        "crf": VIDEO_QUALITY,
+        "threads": VIDEO_ENCODER_THREADS,
+    }
+
+
+def _can_encode(encoder_options: dict) -> bool:
+    """
+    Проверяет пробным кодированием пары кадров, что ffmpeg принимает кодер
+    вместе со всеми параметрами, с которыми будут кодироваться короткие видео.
+    :param encoder_options: Параметры вывода ffmpeg.
+    :return: True, если пробное кодирование прошло успешно.
+    """
+    try:
+        ffmpeg.input("color=c=black:s=256x256:d=0.1", format="lavfi").output(
+            "-", format="null", **encoder_options
+        ).run(quiet=True)
+    except ffmpeg.Error:
+        return False
+    return True
+
+
+def _detect_video_codec() -> str:
+    """
+    Выбирает первый рабочий аппаратный кодер H.264, иначе libx264. Список
+    ffmpeg -encoders показывает лишь собранные в ffmpeg кодеры, а не наличие
+    GPU, поэтому каждый кодер проверяется пробным кодированием пары кадров
+    с его параметрами по умолчанию.
+    :return: Имя кодера для ffmpeg.
+    """
+    for vcodec in HARDWARE_VIDEO_CODECS:
+        if _can_encode(_get_encoder_options(vcodec)):
+            print(f"Для сборки видео выбран аппаратный кодер {vcodec}")
+            return vcodec
+    print("Аппаратные кодеры недоступны, видео кодируется с помощью libx264")
+    return "libx264"
+
+
+def _get_frame_number(frame_name: str) -> int:
+    """
+    Возвращает номер кадра из имени файла вида frame_00000135.jpg или .png.
+    :param frame_name: Имя файла кадра.
+    :return: Номер кадра.
+    """
+    return int(os.path.splitext(frame_name)[0].rsplit("_", 1)[-1])
 
 
 class VideoHandler:
     """
-    Класс для сборки и объединения видео из апскейленных фреймов с
-    автоматическим управлением очередями объединения.
+    Класс для сборки коротких видео из апскейленных фреймов и их объединения
+    в одно видео.
     """
 
-    # Максимальный размер очереди для коротких видео перед началом их объединения
-    MAX_MERGE_QUEUE_SIZE = 4
-    MAX_SHORT_VIDEOS = 8
+    # Без __dict__ у экземпляров: атрибуты хранятся в фиксированных слотах
+    __slots__ = (
+        "fps",
+        "final_video_name",
+        "video_queue",
+        "final_video_path",
+        "vcodec",
+        "_encoder_options",
+        "_executor",
+        "_io_pool",
+        "_pending_batches",
+        "_encoder_sessions",
+    )
 
     def __init__(self, fps: float, tmp_video_name: str = ""):
         self.fps = fps
-        self.current_short_video_count = 0
         self.final_video_name = tmp_video_name
-        self.short_video_queue = Queue(maxsize=2)
-        self.long_video_queue = PriorityQueue(maxsize=self.MAX_MERGE_QUEUE_SIZE)
+        # FIFO-очередь коротких видео (future с путем к видео): объединяются
+        # строго в порядке постановки, а не завершения кодирования
+        self.video_queue = deque()
         self.final_video_path = ""
+        # Кодер выбирается один раз, до запуска параллельного кодирования
+        if VIDEO_CODEC == "auto":
+            # Пресет задается в терминах конкретного кодера, а при auto кодер
+            # выбирается без участия пользователя, поэтому VIDEO_PRESET не
+            # применяется
+            self.vcodec = _detect_video_codec()
+            self._encoder_options = _get_encoder_options(self.vcodec)
+        else:
+            self.vcodec = VIDEO_CODEC
+            self._encoder_options = _get_encoder_options(self.vcodec, VIDEO_PRESET)
+            # Неподходящий кодер или пресет выявляется сразу, а не после
+            # апскейла первого шага
+            if not _can_encode(self._encoder_options):
+                raise Exception(
+                    f"ffmpeg не может кодировать видео кодером {self.vcodec} "
+                    f"с пресетом {self._encoder_options['preset']}"
+                )
+        # Короткие видео кодируются в фоне, пока апскейлер обрабатывает
+        # следующие батчи
+        self._executor = ThreadPoolExecutor(max_workers=ALLOWED_THREADS)
+        # Удаление отработанных файлов идет отдельным потоком, не занимая
+        # потоки кодирования
+        self._io_pool = ThreadPoolExecutor(max_workers=1)
+        # Батчи, фреймы которых еще лежат на диске в ожидании сборки видео
+        self._pending_batches = threading.BoundedSemaphore(MAX_PENDING_BATCHES)
+        # Аппаратный кодер держит ограниченное число сессий на одном GPU (еще и
+        # занятом апскейлером), поэтому одновременно идет не больше
+        # HARDWARE_ENCODER_SESSIONS кодирований. Программный кодер ограничен
+        # только числом потоков пула
+        self._encoder_sessions = threading.BoundedSemaphore(
+            HARDWARE_ENCODER_SESSIONS
+            if self.vcodec in HARDWARE_VIDEO_CODECS
+            else ALLOWED_THREADS
+        )
 
     @staticmethod
-    def _build_video_path(video_name, path=BATCH_VIDEO_PATH):
+    def _build_video_path(video_name, path=BATCH_VIDEO_PATH, extension="mp4"):
         """Генерирует путь к видео с заданным именем."""
-        return os.path.join(path, f"{video_name}.mp4")
+        return os.path.join(path, f"{video_name}.{extension}")
 
     @staticmethod
-    def _collect_frames(batches_list):
-        """Собирает пути фреймов из указанных батчей."""
-        frame_paths = []
+    def _iter_frame_paths(batches_list):
+        """
+        Генерирует пути фреймов из указанных батчей в порядке кадров, не собирая
+        пути всех батчей в один список.
+        """
+        extension = f".{OUTPUT_IMAGE_FORMAT}"
         for batch in batches_list:
-            batch_path = str(os.path.join(OUTPUT_BATCHES_DIR, batch))
-            frame_paths.extend(
-                sorted(glob.glob(os.path.join(batch_path, "frame*.jpg")))
-            )
-        return frame_paths
-
-    @staticmethod
-    def _create_frames_file(frame_paths):
-        """Создает временный файл со списком фреймов для ffmpeg."""
-        frames_file_path = os.path.join("./", "frames_list.txt")
-        with open(frames_file_path, "w") as file:
-            for frame in frame_paths:
-                file.write(f"file '{frame}'\n")
-        return frames_file_path
+            batch_path = os.path.join(OUTPUT_BATCHES_DIR, batch)
+            with os.scandir(batch_path) as entries:
+                frame_names = [
+                    entry.name
+                    for entry in entries
+                    if entry.name.startswith("frame") and entry.name.endswith(extension)
+                ]
+            # Сортируем по номеру кадра, а не по строке: порядок не зависит от
+            # ширины нумерации в именах файлов
+            frame_names.sort(key=_get_frame_number)
+            for name in frame_names:
+                yield os.path.join(batch_path, name)
 
     def _generate_video_from_frames(
-        self, frames_file_path, batch_range_start, batch_range_end
+        self, frame_batches, batch_range_start, batch_range_end
     ):
-        """Создает видео из списка фреймов, используя ffmpeg."""
+        """
+        Создает видео из фреймов указанных батчей, используя ffmpeg. Фреймы
+        передаются через stdin одним потоком изображений в формате
+        OUTPUT_IMAGE_FORMAT (image2pipe): ffmpeg не открывает и не анализирует
+        каждый файл как отдельный вход.
+        """
+        # Короткие видео пишутся в MPEG-TS: такие файлы склеиваются простым
+        # последовательным чтением через протокол concat
         video_path = self._build_video_path(
-            f"short_{batch_range_start}-{batch_range_end}"
+            f"short_{batch_range_start:06d}-{batch_range_end:06d}", extension="ts"
         )
-        ffmpeg.input(frames_file_path, format="concat", safe=0).output(
-            video_path, vcodec="libx264", pix_fmt="yuv420p", crf=18, r=self.fps
-        ).run()
-        self.current_short_video_count += 1
-        return video_path
-
-    def process_frames_to_video(self, frame_batches):
-        """Собирает обработанные фреймы из батчей в одно короткое видео."""
-        batch_range_start = frame_batches[0].split("_")[1]
-        batch_range_end = frame_batches[-1].split("_")[1]
-        frame_paths = self._collect_frames(frame_batches)
-        frames_file_path = self._create_frames_file(frame_paths)
-
-        video_path = self._generate_video_from_frames(
-            frames_file_path, batch_range_start, batch_range_end
+        process = (
+            ffmpeg.input(
+                "pipe:",
+                format="image2pipe",
+                vcodec=IMAGE_DECODERS[OUTPUT_IMAGE_FORMAT],
+                framerate=self.fps,
+            )
+            .output(
+                video_path,
+                r=self.fps,
+                **self._encoder_options,
+            )
+            # Кодирование идет в фоне во время апскейла: баннер и статистика
+            # ffmpeg смешивались бы с прогресс-баром, поэтому выводятся только ошибки
+            .global_args("-loglevel", "error", "-nostats")
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
         )
-        delete_file(frames_file_path)  # Удаляем временный файл списка фреймов
+        try:
+            for frame_path in self._iter_frame_paths(frame_batches):
+                with open(frame_path, "rb") as frame_file:
+                    process.stdin.write(frame_file.read())
+        except BrokenPipeError:
+            # ffmpeg завершился раньше времени, ошибку покажет код возврата
+            pass
+        finally:
+            # ffmpeg дожидается завершения и при ошибке чтения фреймов, иначе
+            # процесс остался бы зомби. close() сбрасывает буфер и тоже может
+            # получить BrokenPipeError, если ffmpeg уже завершился
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            return_code = process.wait()
 
-        self._add_to_queues(video_path)
+        if return_code != 0:
+            raise Exception(f"Не удалось собрать видео {video_path}")
         return video_path
 
-    def _add_to_queues(self, video_path):
-        """Добавляет видео в очереди и выполняет объединение при необходимости."""
-        self.short_video_queue.put(video_path)
-        if self.short_video_queue.full():
-            merged_video = self._merge_two_videos(
-                self.short_video_queue.get(), self.short_video_queue.get()
+    def _generate_video_from_batch(self, batch_num):
+        """
+        Создает короткое видео из фреймов одного батча и удаляет эти фреймы:
+        после кодирования они больше не нужны.
+        """
+        batch = f"batch_{batch_num}"
+        try:
+            # Апскейлер мог пропустить часть фреймов, такое видео было бы
+            # короче исходного и сдвинуло бы звук
+            upscaled_frames = count_frames_in_dir(
+                os.path.join(OUTPUT_BATCHES_DIR, batch)
             )
-            # 2 шортса, объединённые в один - это макс приоритет - 0
-            self.long_video_queue.put((0, merged_video))
-
-        if self.long_video_queue.full():
-            self._merge_long_videos()
-
-    def _merge_two_videos(self, first_video, second_video):
-        """Объединяет два видео в одно."""
-        if os.path.isfile(first_video) and os.path.isfile(second_video):
-            with VideoFileClip(first_video) as clip1, VideoFileClip(
-                second_video
-            ) as clip2:
-                combined_clip = concatenate_videoclips([clip1, clip2])
-                merged_video_path = self._build_video_path(
-                    f"merged_{os.path.basename(first_video).split('.')[0]}_{os.path.basename(second_video).split('.')[0]}"
+            source_frames = count_frames_in_dir(
+                os.path.join(INPUT_BATCHES_DIR, batch), INPUT_IMAGE_FORMAT
+            )
+            if upscaled_frames != source_frames:
+                raise Exception(
+                    f"В батче {batch} улучшено {upscaled_frames} фреймов "
+                    f"из {source_frames}"
                 )
-                combined_clip.write_videofile(
-                    merged_video_path, codec="libx264", fps=self.fps
+            with self._encoder_sessions:
+                video_path = self._generate_video_from_frames(
+                    [batch], batch_num, batch_num
                 )
-                print(f"Слияние видеофайлов завершено: {merged_video_path}")
+        except Exception:
+            self._pending_batches.release()
+            raise
+        self._io_pool.submit(
+            self._delete_batch_frames, os.path.join(OUTPUT_BATCHES_DIR, batch)
+        )
+        return video_path
 
-            delete_file(first_video)
-            delete_file(second_video)
-            return merged_video_path
-        else:
-            raise FileNotFoundError(
-                f"Не удается найти одно из видео: {first_video} или {second_video}"
-            )
+    def _delete_batch_frames(self, batch_path):
+        """Удаляет фреймы собранного батча и освобождает место в лимите батчей."""
+        try:
+            delete_dir(batch_path)
+        finally:
+            self._pending_batches.release()
 
-    def _merge_long_videos(self):
-        """Выполняет попарное объединение видео из основной очереди."""
-        while self.long_video_queue.qsize() >= 2:
-            # если количество видео "побольше" в очереди больше 2х, то объединяем их и
-            # кладём в очередь. Повторяем до тех пор, пока не останется лишь 1 tmp видео
-            priority, first_video = self.long_video_queue.get()
-            _, second_video = self.long_video_queue.get()
-            merged_video = priority + 1, self._merge_two_videos(
-                first_video, second_video
-            )
-            self.long_video_queue.put(merged_video)
+    def reserve_batches(self, batch_range: Tuple[int, int]):
+        """
+        Занимает место в лимите MAX_PENDING_BATCHES для батчей, которые будут
+        улучшены следующими. Вызывается до апскейла: если места нет, вызов
+        блокируется, пока не будут удалены фреймы уже собранных батчей, поэтому
+        на диске одновременно лежит не больше MAX_PENDING_BATCHES улучшенных
+        батчей. Место освобождается после сборки видео батча в
+        process_frames_to_video.
+        :param batch_range: Номера первого и последнего батча включительно.
+        """
+        first_batch, last_batch = batch_range
+        for _ in range(first_batch, last_batch + 1):
+            self._pending_batches.acquire()
 
-        if self.long_video_queue.qsize() == 1:
-            # если в длинной очереди осталось лишь 1 видео, то отдаем видео и путь к нему
-            _, final_merge = self.long_video_queue.get()
-            self.final_video_path = self._build_video_path(
-                self.final_video_name, TMP_VIDEO_PATH
+    def process_frames_to_video(self, batch_range: Tuple[int, int]):
+        """
+        Ставит сборку коротких видео из обработанных фреймов батчей в фоновую
+        очередь, по одному видео на батч, и сразу возвращает управление. Батчи
+        кодируются параллельными процессами ffmpeg, а склеиваются потом в
+        build_final_video без перекодирования. Место для батчей должно быть
+        заранее занято через reserve_batches.
+        :param batch_range: Номера первого и последнего батча включительно.
+        :return: Список future с путями к коротким видео, по одному на батч.
+        """
+        # Ошибка уже завершившегося кодирования прерывает обработку сразу, а не
+        # после апскейла всего видео
+        for future in self.video_queue:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+        first_batch, last_batch = batch_range
+        futures = []
+        for batch_num in range(first_batch, last_batch + 1):
+            futures.append(
+                self._executor.submit(self._generate_video_from_batch, batch_num)
             )
-            os.rename(final_merge, self.final_video_path)
-            print(f"Финальное видео создано: {self.final_video_path}")
+        self.video_queue.extend(futures)
+        return futures
 
-    def __str__(self):
-        """Возвращает количество видео в очередях."""
-        return (
-            f"Количество шортсов в очереди: {self.short_video_queue.qsize()}"
-            f"Количество длинных видео в очереди: {self.long_video_queue.qsize()}"
+    @staticmethod
+    def _streams_match(video_paths):
+        """
+        Проверяет, что видеопотоки всех файлов закодированы с одинаковыми
+        параметрами и их можно склеить без перекодирования.
+        :param video_paths: Пути к видео.
+        :return: True, если параметры потоков совпадают.
+        """
+        stream_keys = ("codec_name", "pix_fmt", "width", "height", "r_frame_rate")
+        stream_params = set()
+        for video_path in video_paths:
+            stream = ffmpeg.probe(video_path, select_streams="v:0")["streams"][0]
+            stream_params.add(tuple(stream.get(key) for key in stream_keys))
+        return len(stream_params) == 1
+
+    def build_final_video(self):
+        """
+        Объединяет все короткие видео из очереди в одно за один вызов ffmpeg.
+        Файлы MPEG-TS подаются на вход протоколом concat одним непрерывным
+        потоком. Если все короткие видео закодированы с одинаковыми
+        параметрами, поток копируется в mp4 без перекодирования.
+        :return: Путь к объединенному видео.
+        """
+        if not self.video_queue:
+            raise FileNotFoundError("Нет коротких видео для объединения")
+
+        video_paths = []
+        while self.video_queue:
+            # Дожидаемся кодирования, если оно еще идет
+            video_path = self.video_queue.popleft().result()
+            if not os.path.isfile(video_path):
+                raise FileNotFoundError(f"Не удается найти видео: {video_path}")
+            video_paths.append(os.path.abspath(video_path))
+
+        self._executor.shutdown()
+
+        self.final_video_path = self._build_video_path(
+            self.final_video_name, TMP_VIDEO_PATH
         )
+        if self._streams_match(video_paths):
+            codec_options = {"c": "copy"}
+        else:
+            # Видео с разными параметрами склеить копированием нельзя,
+            # поэтому только в этом случае перекодируем
+            print("Параметры коротких видео различаются, видео будет перекодировано")
+            # Финальное видео кодирует один процесс, ему доступны все ядра
+            codec_options = {**self._encoder_options, "threads": 0}
+        # +faststart переносит индекс (moov) в начало файла
+        ffmpeg.input(f"concat:{'|'.join(video_paths)}").output(
+            self.final_video_path, movflags="+faststart", **codec_options
+        ).overwrite_output().run()
+        print(f"Финальное видео создано: {self.final_video_path}")
+
+        for video_path in video_paths:
+            self._io_pool.submit(delete_file, video_path)
+        # Дожидаемся удаления фреймов и коротких видео до передачи результата
+        self._io_pool.shutdown(wait=True)
+        return self.final_video_path
+
+    def __str__(self):
+        """Возвращает количество видео в очереди."""
+        return f"Количество шортсов в очереди: {len(self.video_queue)}"
 
     def __repr__(self):
-        """Возвращает количество видео в очередях."""
+        """Возвращает количество видео в очереди."""
         return self.__str__()